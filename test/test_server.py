@@ -7,11 +7,23 @@
 # Usage:
 #   python3 test_server.py
 #   python3 test_server.py ./test_MotionSDK
+#   MOCK_SDK_CHAOS=1 python3 test_server.py ./test_MotionSDK
 #
 # Runs 5 of the Motion data services, Configurable, Preview, Sensor, Raw and
 # Console each on their own port. We reuse the ports that the Motion Service
 # deploys with so this test server will conflict with installed software.
 #
+# All of the services run in one asyncio event loop. Requires Python 3.8 or
+# later, for the Windows subprocess support. Uses uvloop if it is installed.
+#
+# Set MOCK_SDK_CHAOS=1 to send the sample stream in randomly sized chunks,
+# which tests the Client ability to reassemble messages. Otherwise each sample
+# is sent with one write.
+#
+# Set MOCK_SDK_CPU=N to pin the event loop thread to CPU N, Linux only. Pick a
+# CPU near the one that services the network interrupts, see
+# /proc/irq/*/smp_affinity, to reduce latency on multi socket hosts.
+#
 # @file    test/test_server.py
 # @author  Luke Tokheim, luke@motionshadow.com
 # @version 3.0
@@ -41,28 +53,107 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import asyncio
+import os
 import random
+import signal
+import socket
 import struct
-import subprocess
 import sys
-import threading
 import time
 
-# The Python 3 socketserver module was named SocketServer in 2.7. Also, make an
-# alias to BrokenPipeError for 2.7.
-try:
-    import socketserver
-except ImportError:
-    import SocketServer as socketserver
-    from socket import error as BrokenPipeError
-
 HOST = "localhost"
 PORTS = (32075, 32076, 32077, 32078, 32079, 32000)
 
+# Any value other than empty or "0" turns on chunked sends.
+_CHAOS = os.environ.get("MOCK_SDK_CHAOS", "0") not in ("", "0")
+
+# Send up to this many sample messages at once.
+_MAX_COPIES = 5
+
+# Length prefix of every Motion SDK message, unsigned int in network byte
+# order.
+_HDR = struct.Struct("!I")
+
+# Canned sample payloads for one device. Packed once at import rather than on
+# every connection.
+_PREVIEW_DATA = struct.pack(
+    "I14f", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23)
+_SENSOR_DATA = struct.pack("I9f", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18)
+_RAW_DATA = struct.pack("I9h", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18)
+_CONFIGURABLE_DATA = struct.pack(
+    "2I8f", 1, 8, 10, 11, 12, 13, 14, 15, 16, 17)
+_CONSOLE_DATA = b'\0true\n'
+
+# Malformed messages for the Client error handling tests.
+_BAD_HEADER = struct.pack("h", 1)
+_BAD_PAYLOAD = struct.pack("!I2I3f", 40, 1, 8, 10, 11, 12)
+_BAD_LENGTH = struct.pack("!I2I3f", 65536, 1, 8, 10, 11, 12)
+_BAD_XML = _HDR.pack(4) + b'<?xm'
+
+
+def _frame(data):
+    """Convert a byte string to a length prefixed Motion SDK message."""
+    return _HDR.pack(len(data)) + data
+
+
+def _sample_frames(data):
+    """Repeat the sample message for the maximum number of copies that the
+    Handler sends at once. It sends a prefix of this buffer for each sample.
+    """
+    return _frame(data) * _MAX_COPIES
+
+
+def _service_frame(name):
+    return _frame(b'<?xml version="1.0"?><service name="' + name + b'"/>')
+
+
+# Before any sample data, a Motion SDK service always emits the device key to
+# string id list. Same for every service.
+_DEVICE_FRAME = _frame(
+    b'<?xml version="1.0"?><node><node id="Node" key="1"/></node>')
+
+# Complete length prefixed messages for each data service, built once at
+# import. Maps port to (XML header, XML device list, repeated sample, is
+# configurable). The test service has no sample, it responds to the channel
+# list instead.
+_PORT_STATE = {
+    32079: (_service_frame(b"preview"), _DEVICE_FRAME,
+            _sample_frames(_PREVIEW_DATA), False),
+    32078: (_service_frame(b"sensor"), _DEVICE_FRAME,
+            _sample_frames(_SENSOR_DATA), False),
+    32077: (_service_frame(b"raw"), _DEVICE_FRAME,
+            _sample_frames(_RAW_DATA), False),
+    32076: (_service_frame(b"configurable"), _DEVICE_FRAME,
+            _sample_frames(_CONFIGURABLE_DATA), True),
+    32075: (_service_frame(b"console"), _DEVICE_FRAME,
+            _sample_frames(_CONSOLE_DATA), False),
+    32000: (_service_frame(b"test"), _DEVICE_FRAME, None, True),
+}
+
+
+class Handler:
+    def __init__(self, reader, writer):
+        """Called once per TCP session, before handle.
+
+        Tune the session socket for many small, latency sensitive writes.
+        Disable Nagle so each message goes out immediately and use a larger
+        send buffer.
+        """
+        self.reader = reader
+        self.writer = writer
+        # Per session random number generator, seeded from the system.
+        self._randint = random.Random().randint
+
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        # Linux only, acknowledge the Client channel list right away.
+        if hasattr(socket, "TCP_QUICKACK"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
 
-class Handler(socketserver.BaseRequestHandler):
-    def handle(self):
-        """Called from the socketserver to handle a single TCP request/session.
+    async def handle(self):
+        """Handle a single TCP request/session.
 
         Handle the handshaking sequence and then start streaming data as if
         there is one device named "Node" plugged in and acquiring measurements.
@@ -74,96 +165,74 @@ class Handler(socketserver.BaseRequestHandler):
             loop:
                 write(binary message)
         """
-        port = self.server.server_address[1]
-
-        is_configurable = False
-        if port == 32079:
-            name = b"preview"
-        elif port == 32078:
-            name = b"sensor"
-        elif port == 32077:
-            name = b"raw"
-        elif port == 32076:
-            name = b"configurable"
-            is_configurable = True
-        elif port == 32075:
-            name = b"console"
-        else:
-            name = b"test"
-            is_configurable = True
+        port = self.writer.get_extra_info("sockname")[1]
+        service, device, samples, is_configurable = _PORT_STATE[port]
 
         # Motion SDK service always prints out its identity as an XML string.
-        self.write_message(
-            b'<?xml version="1.0"?><service name="' + name + b'"/>')
+        await self.write_frame(service)
 
         if is_configurable:
             # Configurable service requires a channel list.
-            msg = self.read_message()
-
-        # Before any sample data, a Motion SDK service always emits the device
-        # key to string id list.
-        self.write_message(
-            b'<?xml version="1.0"?><node><node id="Node" key="1"/></node>')
-
-        # One device. Fill out a canned message based on which data service
-        # we are implementing.
-        if port == 32079:
-            data = struct.pack(
-                "I14f", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22,
-                23)
-        elif port == 32078:
-            data = struct.pack("I9f", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18)
-        elif port == 32077:
-            data = struct.pack("I9h", 1, 10, 11, 12, 13, 14, 15, 16, 17, 18)
-        elif port == 32076:
-            data = struct.pack("2I8f", 1, 8, 10, 11, 12, 13, 14, 15, 16, 17)
-        elif port == 32075:
-            data = struct.pack("6s", b'\0true\n')
-        else:
+            msg = await self.read_message()
+
+        await self.write_frame(device)
+
+        # One device. Canned sample message based on which data service we
+        # are implementing.
+        if samples is None:
             if msg.find(b"header") != -1:
-                buf = struct.pack("h", 1)
+                buf = _BAD_HEADER
             elif msg.find(b"payload") != -1:
-                buf = struct.pack("!I2I3f", 40, 1, 8, 10, 11, 12)
+                buf = _BAD_PAYLOAD
             elif msg.find(b"length") != -1:
-                buf = struct.pack("!I2I3f", 65536, 1, 8, 10, 11, 12)
+                buf = _BAD_LENGTH
             elif msg.find(b"xml") != -1:
-                buf = self.make_message(b'<?xm')
+                buf = _BAD_XML
 
-            self.request.sendall(buf)
+            await self.write_frame(buf)
             if msg.find(b"timeout") != -1:
-                self.read_message()
+                await self.read_message()
             else:
-                time.sleep(0.25)
+                await asyncio.sleep(0.25)
             return
 
-        for i in range(0, 100):
-            # Binary message for one sample. Prefixed with length.
-            msg = self.make_message(data)
-            # Make 1-5 copies to send at random intervals. Try to test the
-            # Client ability to receive messages broken into strange chunks.
-            msg = b''.join([msg] * random.randint(1, 5))
-
-            dt = 0
-            j = 0
-            while j < len(msg):
-                n = random.randint(j, len(msg))
-
-                try:
-                    self.request.sendall(msg[j:n])
-                except BrokenPipeError:
-                    return
-                except ConnectionAbortedError:
-                    return
-                j = n
+        # Send 1-5 copies of the binary sample message at random intervals. Try
+        # to test the Client ability to receive messages broken into strange
+        # chunks. Send a slice of the prebuilt copies, no copy per sample.
+        size = len(samples) // _MAX_COPIES
+        buf = memoryview(samples)
 
-                time.sleep(0.001)
-                dt = dt + 0.001
-
-            dt = 0.01 - dt
-            if dt > 0:
-                time.sleep(dt)
+        # Stream at 100 Hz. Schedule against a monotonic deadline so the rate
+        # does not drift with the time spent writing.
+        randint = self._randint
+        next_t = time.monotonic()
+        for i in range(0, 100):
+            msg = buf[:size * randint(1, _MAX_COPIES)]
 
-    def read_message(self):
+            if not _CHAOS:
+                if not await self.write_frame(msg):
+                    return
+            else:
+                # Split the message at 1-5 random points, with a short pause
+                # after each chunk so they arrive separately.
+                cuts = sorted(
+                    randint(0, len(msg)) for _ in range(randint(1, 5)))
+                cuts.append(len(msg))
+
+                j = 0
+                for n in cuts:
+                    if not await self.write_frame(msg[j:n]):
+                        return
+                    j = n
+
+                    await asyncio.sleep(0.001)
+
+            next_t += 0.01
+            delay = next_t - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def read_message(self):
         """Read a variable length binary message from the socket.
 
         All Motion SDK messages are prefixed with an unsigned int in network
@@ -173,94 +242,141 @@ class Handler(socketserver.BaseRequestHandler):
 
         Returns a byte string if sucessful, otherwise returns None.
         """
-        header = self.request.recv(4)
-        if header is None or len(header) != 4:
-            return None
+        try:
+            header = await self.reader.readexactly(4)
 
-        length = struct.unpack("!I", header)[0]
-        if length <= 0 or length > 65535:
-            return None
+            length = _HDR.unpack(header)[0]
+            if length <= 0 or length > 65535:
+                return None
 
-        message = self.request.recv(length)
-        if message is None or len(message) != length:
+            return await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+        except ConnectionError:
             return None
 
-        return message
-
-    def write_message(self, data):
-        """Write a binary message to the socket.
-
-        Convert the byte string data to a Motion SDK length prefixed message.
+    async def write_frame(self, message):
+        """Write raw bytes to the socket.
 
         Returns true is all of the data was sucessfully sent, otherwise returns
         false.
         """
         try:
-            self.request.sendall(self.make_message(data))
+            self.writer.write(message)
+            await self.writer.drain()
             return True
-        except BrokenPipeError:
+        except ConnectionError:
             return False
-        except ConnectionAbortedError:
-            return False
-
-    def make_message(self, data):
-        """Convert a byte string to a Motion SDK binary message.
-
-        Returns a byte string starting with the 4 header bytes followed by the
-        data payload.
-        """
-        length = len(data)
-        message = struct.pack("!I" + str(length) + "s", length, data)
-
-        return message
 #
 # class Handler
 #
 
 
-class SDKServer:
-    def __init__(self, address):
-        self.server = socketserver.TCPServer(address, Handler)
+async def _handle(reader, writer):
+    """Called from the asyncio server for each new Client connection."""
+    try:
+        await Handler(reader, writer).handle()
+    except asyncio.CancelledError:
+        # Event loop shut down with this session still open.
+        pass
+    finally:
+        writer.close()
 
-    def start_thread(self):
-        self.thread = threading.Thread(target=self.server.serve_forever)
-        # Exit the server thread when the main thread terminates
-        self.thread.daemon = True
-        self.thread.start()
 
-    def stop_thread(self):
-        self.server.shutdown()
-        self.server.server_close()
+def read_cpu():
+    """Read the CPU index from MOCK_SDK_CPU.
 
-        self.thread.join()
+    Returns None if it is not set or the platform does not support CPU
+    affinity. Exits with an error message if it is not a CPU that this process
+    is allowed to run on.
+    """
+    value = os.environ.get("MOCK_SDK_CPU")
+    if value is None or not hasattr(os, "sched_setaffinity"):
+        return None
 
-    def join_thread(self, timeout=None):
-        self.thread.join(timeout)
-#
-# class SDKServer
-#
+    allowed = os.sched_getaffinity(0)
+    try:
+        cpu = int(value)
+    except ValueError:
+        cpu = None
 
+    if cpu not in allowed:
+        sys.exit("MOCK_SDK_CPU={} is not a valid CPU, choose one of {}".format(
+            value, sorted(allowed)))
 
-def main():
-    random.seed()
+    return cpu
+
+
+def pin_cpu(cpu):
+    """Pin the event loop thread to the CPU index, if it is not None.
+
+    Only the calling thread is pinned. Threads that the event loop already
+    started, like the default executor, keep their affinity.
+    """
+    if cpu is None:
+        return
+
+    os.sched_setaffinity(0, {cpu})
 
-    socketserver.TCPServer.allow_reuse_address = True
 
-    server_list = [SDKServer((HOST, port)) for port in PORTS]
+async def serve(argv, cpu=None):
+    """Run all of the data services in one event loop.
 
-    for s in server_list:
-        s.start_thread()
+    Serve forever, or until the command in argv completes. Returns the exit
+    code of the command. Pin the event loop thread to cpu if it is not None.
+    """
+    server_list = [
+        await asyncio.start_server(
+            _handle, HOST, port, reuse_address=True, backlog=128)
+        for port in PORTS]
 
     rc = 0
-    if len(sys.argv) > 1:
-        rc = subprocess.call(sys.argv[1])
-    else:
-        while True:
-            for s in server_list:
-                s.join_thread(1)
+    try:
+        if argv:
+            # Start the command first so it does not inherit the CPU affinity.
+            process = await asyncio.create_subprocess_exec(*argv)
+            pin_cpu(cpu)
+            rc = await process.wait()
+        else:
+            pin_cpu(cpu)
+            # The servers are already accepting connections. Park until
+            # interrupted, then shut down cleanly. Windows event loops do not
+            # support signal handlers, Ctrl+C raises KeyboardInterrupt there.
+            stop = asyncio.Event()
+            try:
+                asyncio.get_running_loop().add_signal_handler(
+                    signal.SIGINT, stop.set)
+            except NotImplementedError:
+                pass
+            await stop.wait()
+    finally:
+        # Stop accepting connections. Open sessions are cancelled when the
+        # event loop shuts down.
+        for s in server_list:
+            s.close()
+
+    return rc
+
 
-    for s in server_list:
-        s.stop_thread()
+def main():
+    cpu = read_cpu()
+
+    # Optional, the libuv based event loop has lower overhead per write.
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    if uvloop is None:
+        rc = asyncio.run(serve(sys.argv[1:2], cpu))
+    elif sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            rc = runner.run(serve(sys.argv[1:2], cpu))
+    else:
+        # Event loop policies are deprecated in newer versions of Python and
+        # uvloop, only install one where there is no Runner.
+        uvloop.install()
+        rc = asyncio.run(serve(sys.argv[1:2], cpu))
 
     sys.exit(rc)
 